@@ -1,15 +1,24 @@
-from typing import List, Optional, Dict, Any
+import re
+from collections import OrderedDict
+from typing import List, Optional, Dict, Any, Tuple
 
-from llama_index.llms.openai_like import OpenAILike
 from llama_index.core.agent import FunctionAgent
 
 from mcp_client_init import McpMqttClient
 
-from utils.prompt_loader import load_system_prompt
+from utils.llm_clients import get_shared_llm
+from utils.prompt_loader import EMOTION_PROMPT_FILE, load_system_prompt
 from utils.colored_logger import get_agent_logger
 
 logger = get_agent_logger("emotion")
 
+# Maximum number of user inputs whose tool calls are remembered
+TOOL_CALL_CACHE_SIZE = 128
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s]+")
+
+ToolCalls = List[Tuple[str, Dict[str, Any]]]
+
 
 class EmotionAgent:
     """Agent specialized in emotion control - manages avatar facial expressions"""
@@ -20,18 +29,16 @@ class EmotionAgent:
         api_base: str,
         model: str,
         temperature: float = 0.0,
-        max_tokens: int = 1000,
-        system_prompt_file: str = "prompts/emotion_system_prompt.txt",
+        max_tokens: int = 256,
+        system_prompt_file: str = EMOTION_PROMPT_FILE,
     ):
         self.api_key = api_key
 
-        # LLM initialization for emotion control
-        self.llm = OpenAILike(
+        # LLM initialization for emotion control, shared by agents with the same config
+        self.llm = get_shared_llm(
             model=model,
             api_key=self.api_key,
             api_base=api_base,
-            is_chat_model=True,
-            is_function_calling_model=True,
             temperature=temperature,
             max_tokens=max_tokens,
             timeout=30,
@@ -45,6 +52,9 @@ class EmotionAgent:
         self.mcp_client: Optional[McpMqttClient] = None
         self.agent: Optional[FunctionAgent] = None
 
+        # Tool calls decided for previous inputs. The agent runs without memory,
+        # so the same input always maps to the same decision and repeats can skip the LLM.
+        self._tool_call_cache: OrderedDict[str, ToolCalls] = OrderedDict()
 
     def set_mcp_client(self, mcp_client: McpMqttClient):
         """Set MCP client"""
@@ -66,6 +76,9 @@ class EmotionAgent:
                 else:
                     logger.debug(f"skipped tool: {tool_name}")
 
+            # Cached decisions may reference tools that no longer exist
+            self._tool_call_cache.clear()
+
             self.agent = FunctionAgent(
                 tools=filtered_tools,
                 llm=self.llm,
@@ -79,17 +92,34 @@ class EmotionAgent:
 
     async def determine_and_call_tools(self, user_input: str, context: str = "") -> Optional[Dict[str, Any]]:
         try:
-            if not self.agent:
+            # Capture the agent once so a concurrent MCP reload can't swap it mid-call
+            agent = self.agent
+            if not agent:
                 logger.warning("not initialized")
                 return None
 
+            cache_key = self.normalize_input(user_input)
+            tool_calls = self._lookup(cache_key)
+            if tool_calls is not None:
+                logger.info("processing user input... cache_hit=True")
+                result = await self._replay_tool_calls(agent, tool_calls)
+                return {
+                    "tool_name": "function_agent",
+                    "tool_args": {"user_input": user_input},
+                    "tool_result": result
+                }
+
             logger.info("processing user input...")
 
             import asyncio
             try:
-                response = await asyncio.wait_for(self.agent.run(user_input), timeout=8.0)
+                response = await asyncio.wait_for(agent.run(user_input), timeout=8.0)
                 logger.info(f"completed: {response}")
 
+                tool_calls = [(call.tool_name, call.tool_kwargs) for call in response.tool_calls]
+                if tool_calls and not any(call.tool_output.is_error for call in response.tool_calls):
+                    self._remember(cache_key, tool_calls)
+
                 return {
                     "tool_name": "function_agent",
                     "tool_args": {"user_input": user_input},
@@ -102,3 +132,34 @@ class EmotionAgent:
         except Exception as e:
             logger.error(f"error: {e}")
             return None
+
+    @staticmethod
+    def normalize_input(user_input: str) -> str:
+        """Normalize a user input: punctuation dropped, whitespace collapsed, lowercased"""
+        return " ".join(_PUNCTUATION_RE.sub(" ", user_input).lower().split())
+
+    def _lookup(self, key: str) -> Optional[ToolCalls]:
+        tool_calls = self._tool_call_cache.get(key)
+        if tool_calls is not None:
+            self._tool_call_cache.move_to_end(key)
+        return tool_calls
+
+    def _remember(self, key: str, tool_calls: ToolCalls):
+        cache = self._tool_call_cache
+        cache[key] = tool_calls
+        cache.move_to_end(key)
+        if len(cache) > TOOL_CALL_CACHE_SIZE:
+            cache.popitem(last=False)
+
+    async def _replay_tool_calls(self, agent: FunctionAgent, tool_calls: ToolCalls) -> str:
+        """Call the cached tools directly, skipping the LLM decision"""
+        tools = {tool.metadata.name: tool for tool in agent.tools}
+        results = []
+        for tool_name, tool_kwargs in tool_calls:
+            tool = tools.get(tool_name)
+            if tool is None:
+                logger.warning(f"cached tool {tool_name} is no longer available")
+                continue
+            output = await tool.acall(**tool_kwargs)
+            results.append(str(output))
+        return "\n".join(results)
@@ -1,69 +1,116 @@
+import asyncio
+import re
 import time
+from collections import OrderedDict
+from hashlib import blake2b
 from typing import List, AsyncGenerator, Optional
 
+import orjson
+
 from llama_index.llms.openai_like import OpenAILike
 from llama_index.core.agent import FunctionAgent
+from llama_index.core.agent.workflow import AgentStream, ToolCall
+from llama_index.core.llms import ChatMessage
 from llama_index.core.tools import BaseTool, FunctionTool
 from llama_index.core.memory import Memory
+from llama_index.core.storage.chat_store.base_db import MessageStatus
 
-from tools import explain_photo, explain_photo_async
+from tools import explain_photo_async
 
-from utils.prompt_loader import load_system_prompt
+from utils.llm_clients import get_shared_llm
+from utils.prompt_loader import VOICE_REPLY_PROMPT_FILE, load_system_prompt
 from utils.colored_logger import get_agent_logger
 
 from mcp_client_init import McpMqttClient
 
 logger = get_agent_logger("voice")
 
+# Maximum number of cached responses, shared by all voice agents
+RESPONSE_CACHE_SIZE = 128
+# Number of trailing history messages that are part of the response cache key
+RESPONSE_CACHE_HISTORY = 4
+# Characters per streamed slice of a canned reply
+CANNED_REPLY_SLICE = 4
+# Tokens of recent history replayed verbatim each turn
+MEMORY_TOKEN_LIMIT = 384
+# Tokens of the oldest history dropped at once when it overflows
+MEMORY_TOKEN_FLUSH_SIZE = 128
+
 
 class VoiceAgent:
     """Voice agent with FunctionAgent - supports tool calling and streaming text generation"""
 
+    # Response fingerprint -> streamed tokens. Only responses that needed no tool call are kept.
+    _response_cache: "OrderedDict[str, List[str]]" = OrderedDict()
+
+    # Trivial inputs answered without the LLM, matched against the stripped, lowercased input.
+    # Acknowledgements such as "ok" or "sure" are left out in every language, they may answer a question the agent asked.
+    _canned_replies = (
+        (re.compile(r"^(你好|您好|嗨|哈喽)[呀啊！!。.~]*$"), "嗨，见到你真开心！"),
+        (re.compile(r"^(hi|hello|hey)( there)?[!.~]*$"), "Hi, so happy to see you!"),
+        (re.compile(r"^(谢谢|多谢|谢谢你|谢啦)[呀啊！!。.~]*$"), "不客气呀！"),
+        (re.compile(r"^(thanks|thank you)[!.~]*$"), "You're welcome!"),
+        (re.compile(r"^(再见|拜拜)[呀啊！!。.~]*$"), "再见，下次再聊哦！"),
+        (re.compile(r"^(bye|goodbye|see you)[!.~]*$"), "Bye, talk to you soon!"),
+    )
+
     def __init__(
         self,
         api_key: str,
         api_base: str,
         model: str,
         temperature: float = 0.6,
-        max_tokens: int = 5000,
-        system_prompt_file: str = "prompts/voice_reply_system_prompt.txt",
+        max_tokens: int = 512,
+        system_prompt_file: str = VOICE_REPLY_PROMPT_FILE,
         device_id: Optional[str] = None,
     ):
         self.api_key = api_key
 
-        # LLM initialization for conversation
-        self.llm = OpenAILike(
+        # LLM for conversation, shared with other agents of the same config once the prompt prefix is known
+        self._llm_config = dict(
             model=model,
             api_key=self.api_key,
             api_base=api_base,
-            is_chat_model=True,
-            is_function_calling_model=True,
             temperature=temperature,
             max_tokens=max_tokens,
             timeout=60,
         )
+        self.llm: Optional[OpenAILike] = None
 
+        # Kept byte-identical across turns so providers can reuse the cached prompt prefix
         self.system_prompt = load_system_prompt(system_prompt_file)
 
+        # Everything that shapes a reply besides the history and the input
+        prompt_hash = blake2b(digest_size=16)
+        for part in (model, str(temperature), self.system_prompt):
+            prompt_hash.update(part.encode())
+            prompt_hash.update(b"\0")
+        self._prompt_hash = prompt_hash.digest()
+
         # Tools and agent
         self.tools: List[BaseTool] = []
         self.mcp_tools: List[BaseTool] = []
+        self._filtered_mcp_tools: List[BaseTool] = []
         self.mcp_client: Optional[McpMqttClient] = None
         self._init_base_tools()
 
+        # No LLM-backed memory block: the agent flushes memory before the stream ends,
+        # so condensing old turns there would add an LLM round trip to the turn
         self.memory = Memory.from_defaults(
-            token_limit=1000,
-            session_id=f"session_{device_id or 'voice'}"
+            token_limit=MEMORY_TOKEN_LIMIT,
+            token_flush_size=MEMORY_TOKEN_FLUSH_SIZE,
+            session_id=f"session_{device_id or 'voice'}",
         )
 
         # Agent instance
         self.agent: Optional[FunctionAgent] = None
+        self._tools_fingerprint: frozenset = frozenset()
         self._initialize_agent()
 
     def _init_base_tools(self):
         """Initialize base tools"""
+        # Async only, so a photo question never blocks the event loop in the sync client
         photo_tool = FunctionTool.from_defaults(
-            fn=explain_photo,
             name="explain_photo",
             description=(
                 "Analyze and explain a photo based on a specific question. "
@@ -77,20 +124,25 @@ class VoiceAgent:
 
     def _initialize_agent(self):
         """Initialize agent"""
-        # Filter out change_emotion tool, other tools can be used
-        filtered_mcp_tools = []
-
-        for tool in self.mcp_tools:
-            tool_name = tool.metadata.name if hasattr(tool, 'metadata') and hasattr(tool.metadata, 'name') else str(tool)
-            logger.debug(f"checking tool: {tool_name}")
-            if tool_name != "change_emotion":
-                filtered_mcp_tools.append(tool)
-                logger.debug(f"included tool: {tool_name}")
-            else:
-                logger.debug(f"filtered out tool: {tool_name}")
-
-        all_tools = self.tools + filtered_mcp_tools
+        # A stable tool order keeps the prompt prefix byte-identical across MCP reloads
+        all_tools = sorted(self.tools + self._filtered_mcp_tools, key=lambda tool: tool.metadata.name)
 
+        tools_fingerprint = frozenset(
+            (tool.metadata.name, tool.metadata.description, tool.metadata.fn_schema_str) for tool in all_tools
+        )
+        if self.llm is None or tools_fingerprint != self._tools_fingerprint:
+            self._tools_fingerprint = tools_fingerprint
+            # Lets the provider reuse its cached prefill for the system prompt and tool schemas
+            prefix_hash = blake2b(self.system_prompt.encode())
+            for tool in all_tools:
+                prefix_hash.update(orjson.dumps(tool.metadata.to_openai_tool(skip_length_check=True), option=orjson.OPT_SORT_KEYS))
+            self._prefix_hash = prefix_hash.hexdigest()
+            self.llm = get_shared_llm(**self._llm_config, prompt_cache_key=self._prefix_hash)
+        else:
+            logger.debug("tool schemas unchanged, keeping prompt prefix")
+
+        # Reloaded MCP tools are bound to the new session, so a new agent is built and swapped in.
+        # A stream already running keeps the agent it captured.
         self.agent = FunctionAgent(
             tools=all_tools,
             llm=self.llm,
@@ -101,42 +153,69 @@ class VoiceAgent:
             max_function_calls=5,
         )
 
-        logger.info(f"initialized with {len(all_tools)} tools: {[tool.metadata.name if hasattr(tool, 'metadata') else str(tool) for tool in all_tools]}")
+        logger.info(f"initialized with {len(all_tools)} tools: {[tool.metadata.name for tool in all_tools]}")
 
     def set_mcp_tools(self, mcp_tools: List[BaseTool]):
         """Set MCP tools"""
         self.mcp_tools = mcp_tools
+        # Filter out change_emotion tool, other tools can be used
+        self._filtered_mcp_tools = [tool for tool in mcp_tools if tool.metadata.name != "change_emotion"]
         self._initialize_agent()
 
     def set_mcp_client(self, mcp_client: McpMqttClient):
         """Set MCP client"""
         self.mcp_client = mcp_client
         if mcp_client and mcp_client.mcp_tools:
-            self.mcp_tools = mcp_client.mcp_tools
-            self._initialize_agent()
+            self.set_mcp_tools(mcp_client.mcp_tools)
 
     async def generate_response_stream(self, user_input: str) -> AsyncGenerator[str, None]:
         """Generate streaming response - using FunctionAgent"""
         try:
             start_time = time.time()
 
-            if not self.agent:
+            # Capture the agent once so a concurrent MCP reload can't swap it mid-stream
+            agent = self.agent
+            if not agent:
                 logger.error("Voice agent not initialized")
                 yield "Sorry, voice agent not initialized."
                 return
 
-            accumulated_content = ""
+            canned_reply = self._match_canned_reply(user_input)
+            if canned_reply is not None:
+                logger.info("canned reply, skipping LLM")
+                for i in range(0, len(canned_reply), CANNED_REPLY_SLICE):
+                    yield canned_reply[i:i + CANNED_REPLY_SLICE]
+                    await asyncio.sleep(0)
+                await self._remember_turn(user_input, canned_reply)
+                return
+
+            cache_key = await self._response_cache_key(user_input)
+            cached_tokens = self._response_cache.get(cache_key)
+            if cached_tokens is not None:
+                self._response_cache.move_to_end(cache_key)
+                logger.info(f"first token: {time.time() - start_time:.3f}s, cache_hit=True")
+                for token in cached_tokens:
+                    yield token
+                    await asyncio.sleep(0)
+                await self._remember_turn(user_input, "".join(cached_tokens))
+                return
+
+            accumulated_len = 0
             first_token_time = None
+            tokens: List[str] = []
+            tool_called = False
 
-            handler = self.agent.run(user_msg=user_input, memory=self.memory)
+            handler = agent.run(user_msg=user_input, memory=self.memory)
 
             async for event in handler.stream_events():
-                # Extract content
-                token = None
-                if hasattr(event, 'delta') and event.delta:
+                # Only AgentStream events carry streamed text
+                if isinstance(event, AgentStream):
                     token = event.delta
-                elif hasattr(event, 'chunk') and event.chunk:
-                    token = event.chunk
+                elif isinstance(event, ToolCall):
+                    tool_called = True
+                    continue
+                else:
+                    continue
 
                 if token:
                     # Record first token time
@@ -145,19 +224,55 @@ class VoiceAgent:
                         time_to_first_token = first_token_time - start_time
                         logger.info(f"first token: {time_to_first_token:.3f}s")
 
-                    accumulated_content += token
+                    accumulated_len += len(token)
+                    tokens.append(token)
                     yield token
 
+            # Tool results depend on the outside world, so those replies are never replayed
+            if tokens and not tool_called:
+                self._remember_response(cache_key, tokens)
+
             stream_end = time.time()
             total_time = stream_end - start_time
 
-            logger.info(f"response complete: {total_time:.3f}s, {len(accumulated_content)} chars")
+            logger.info(f"response complete: {total_time:.3f}s, {accumulated_len} chars")
 
         except Exception as e:
             logger.error(f"error in response generation: {e}")
             yield f"Sorry, I encountered some issues: {str(e)}"
 
 
+    def _match_canned_reply(self, user_input: str) -> Optional[str]:
+        normalized = user_input.strip().lower()
+        for pattern, reply in self._canned_replies:
+            if pattern.match(normalized):
+                return reply
+        return None
+
+    async def _remember_turn(self, user_input: str, reply: str):
+        """Record a turn answered without running the agent"""
+        await self.memory.aput(ChatMessage(role="user", content=user_input))
+        await self.memory.aput(ChatMessage(role="assistant", content=reply))
+
+    async def _response_cache_key(self, user_input: str) -> str:
+        """Fingerprint the prompt, the tool schemas, the recent history and the normalized user input"""
+        fingerprint = blake2b(self._prompt_hash, digest_size=16)
+        # The cache is shared by all devices, a reply is only valid where the same tools were offered
+        fingerprint.update(self._prefix_hash.encode())
+        # Only the live history, archived messages would be loaded from the store for nothing
+        messages = await self.memory.aget_all(status=MessageStatus.ACTIVE)
+        for message in messages[-RESPONSE_CACHE_HISTORY:]:
+            fingerprint.update(f"{message.role}\0{message.content or ''}\0".encode())
+        fingerprint.update(user_input.strip().lower().encode())
+        return fingerprint.hexdigest()
+
+    def _remember_response(self, cache_key: str, tokens: List[str]):
+        cache = self._response_cache
+        cache[cache_key] = tokens
+        cache.move_to_end(cache_key)
+        if len(cache) > RESPONSE_CACHE_SIZE:
+            cache.popitem(last=False)
+
     def clear_history(self):
         """Clear conversation history"""
         logger.info("history cleared")
@@ -1,19 +1,34 @@
+from __future__ import annotations
+
 import os
 import time
-import json
+import orjson
+import functools
 import anyio
-from typing import Optional, AsyncGenerator, Dict, Any
+from typing import TYPE_CHECKING, Optional, AsyncGenerator, Dict, Any, Tuple
 from dataclasses import dataclass
 from enum import Enum
 
-from mcp_client_init import McpMqttClient
-from mcp.shared.mqtt import MqttOptions
-from agents.emotion_agent import EmotionAgent
-from agents.voice_agent import VoiceAgent
 from utils.colored_logger import get_agent_logger
+from utils.prompt_loader import EMOTION_PROMPT_FILE, VOICE_REPLY_PROMPT_FILE
+
+# The MCP SDK and agent (LlamaIndex) modules are imported where they are first
+# needed, so importing this module stays cheap for the CLI drivers.
+if TYPE_CHECKING:
+    from mcp.shared.mqtt import MqttOptions
+    from mcp_client_init import McpMqttClient
 
 logger = get_agent_logger("chat")
 
+# Monotonic clock for latency measurements, unaffected by wall-clock jumps
+_now = time.monotonic
+
+_DEFAULT_CLIENTID = os.getenv("MQTT_CLIENT_ID") or f"mcp_ai_companion_{os.getpid()}"
+
+# Pre-encoded loading status payloads sent on every chat turn
+_LOADING_PROCESSING = orjson.dumps({"type": "loading", "status": "processing"})
+_LOADING_COMPLETE = orjson.dumps({"type": "loading", "status": "complete"})
+
 
 class ResponseType(Enum):
     STREAM_CHUNK = "stream_chunk"
@@ -22,7 +37,10 @@ class ResponseType(Enum):
     ERROR = "error"
 
 
-@dataclass
+_STREAM_CHUNK = ResponseType.STREAM_CHUNK
+
+
+@dataclass(slots=True)
 class AgentResponse:
     type: ResponseType
     content: str = ""
@@ -31,6 +49,19 @@ class AgentResponse:
     tool_result: Optional[str] = None
 
 
+@functools.cache
+def _mqtt_options() -> MqttOptions:
+    """MQTT options built once from the environment and shared by all workflows"""
+    from mcp.shared.mqtt import MqttOptions
+
+    return MqttOptions(
+        host=os.getenv("MQTT_BROKER_HOST") or "localhost",
+        port=int(os.getenv("MQTT_BROKER_PORT") or 1883),
+        username=None,
+        password=None,
+    )
+
+
 class ConversationWorkflow:
     """Conversation workflow that coordinates voice responses and tool calls"""
 
@@ -39,10 +70,10 @@ class ConversationWorkflow:
         api_key: str = None,
         api_base: str = "https://dashscope.aliyuncs.com/compatible-mode/v1",
         model: str = "qwen-flash",
-        voice_prompt_file: str = "prompts/voice_reply_system_prompt.txt",
-        tool_prompt_file: str = "prompts/emotion_system_prompt.txt",
+        voice_prompt_file: str = VOICE_REPLY_PROMPT_FILE,
+        tool_prompt_file: str = EMOTION_PROMPT_FILE,
         temperature: float = 0.5,
-        max_tokens: int = 5000,
+        max_tokens: int = 512,
         device_id: Optional[str] = None,
     ):
         self.api_key = api_key or os.environ.get("DASHSCOPE_API_KEY")
@@ -50,6 +81,11 @@ class ConversationWorkflow:
             raise ValueError("API key is required")
 
         self.device_id = device_id
+        # MQTT topic for device messages, set once MCP is connected
+        self._device_topic: Optional[str] = None
+
+        from agents.emotion_agent import EmotionAgent
+        from agents.voice_agent import VoiceAgent
 
         self.voice_agent = VoiceAgent(
             api_key=self.api_key,
@@ -67,13 +103,24 @@ class ConversationWorkflow:
             model=model,
             system_prompt_file=tool_prompt_file,
             temperature=0.0,
-            max_tokens=1000,
+            max_tokens=256,
         )
 
         self.mcp_client: Optional[McpMqttClient] = None
 
         logger.info("initialized")
         self.tg = anyio.create_task_group()
+        self._bg_tg: Optional[anyio.abc.TaskGroup] = None
+        self._tool_scopes: set[anyio.CancelScope] = set()
+        # In-flight tool calls keyed by normalized user input: (done event, result holder)
+        self._inflight_tool_calls: Dict[str, Tuple[anyio.Event, list]] = {}
+
+    async def _run_mcp_client(self):
+        """Run the MQTT client, keeping its failure from cancelling the hosting task group"""
+        try:
+            await self.mcp_client.start()
+        except Exception as e:
+            logger.error("MCP client stopped: %s", e)
 
     def _reinit_agents(self):
         """Simple reinit function when MCP tools are updated"""
@@ -89,100 +136,113 @@ class ConversationWorkflow:
 
     async def init_mcp(
         self,
+        task_group: Optional[anyio.abc.TaskGroup] = None,
         server_name_filter: str = "#",
         device_id: Optional[str] = None
     ):
-        """Initialize MCP client"""
-        device_to_use = device_id or self.device_id
+        """
+        Initialize MCP client
 
-        mqtt_options = MqttOptions(
-            host=os.getenv("MQTT_BROKER_HOST") or "localhost",
-            port=int(os.getenv("MQTT_BROKER_PORT") or 1883),
-            username=None,
-            password=None,
-        )
+        Args:
+            task_group: Hosts the MQTT client and tool calls, the workflow's own group is entered when omitted
+        """
+        from mcp_client_init import McpMqttClient
 
-        mqtt_clientid = os.getenv("MQTT_CLIENT_ID") or f"mcp_ai_companion_{os.getpid()}"
+        device_to_use = device_id or self.device_id
 
         self.mcp_client = McpMqttClient(
-            mqtt_options=mqtt_options,
+            mqtt_options=_mqtt_options(),
             client_name="ai_companion_demo",
             server_name_filter=server_name_filter,
-            clientid=mqtt_clientid,
+            clientid=_DEFAULT_CLIENTID,
             device_id=device_to_use,
             on_tools_updated=self._reinit_agents
         )
 
         # Start MCP
-        await self.tg.__aenter__()
-        self.tg.start_soon(self.mcp_client.start)
+        if task_group is None:
+            await self.tg.__aenter__()
+            task_group = self.tg
+        self._bg_tg = task_group
+        task_group.start_soon(self._run_mcp_client)
 
         # Wait for connection
         connected = await self.mcp_client.connect()
         if connected:
-            logger.info(f"MCP connected with device {device_to_use}")
+            logger.info("MCP connected with device %s", device_to_use)
             self.device_id = device_to_use
+            self._device_topic = f"$message/{device_to_use}"
 
             # Wait for tools to load
             max_wait_time = 10  # seconds
-            wait_interval = 0.5  # seconds
-            waited_time = 0
-
-            while waited_time < max_wait_time:
-                if self.mcp_client.mcp_tools:
-                    logger.info(f"MCP tools loaded: {len(self.mcp_client.mcp_tools)} tools")
-
-                    # Set MCP client for emotion control agent
-                    self.emotion_agent.set_mcp_client(self.mcp_client)
+            if not await self.mcp_client.wait_tools_ready(max_wait_time):
+                logger.warning("no MCP tools loaded after %ss timeout", max_wait_time)
+            else:
+                logger.info("MCP tools loaded: %d tools", len(self.mcp_client.mcp_tools))
 
-                    # Set MCP client for voice response agent
-                    self.voice_agent.set_mcp_client(self.mcp_client)
-                    break
+                # Set MCP client for emotion control agent
+                self.emotion_agent.set_mcp_client(self.mcp_client)
 
-                await anyio.sleep(wait_interval)
-                waited_time += wait_interval
-                logger.debug(f"waiting for MCP tools... ({waited_time:.1f}s)")
-
-            if not self.mcp_client.mcp_tools:
-                logger.warning(f"no MCP tools loaded after {max_wait_time}s timeout")
+                # Set MCP client for voice response agent
+                self.voice_agent.set_mcp_client(self.mcp_client)
         else:
             logger.error("failed to connect MCP")
 
-    async def message_to_device(self, message_type: str, payload: Any) -> bool:
-        """Send message to device"""
-        if not self.mcp_client or not self.device_id:
+    async def message_to_device(
+        self,
+        message_type: str,
+        payload: Any,
+        *,
+        raw: bool = False,
+    ) -> bool:
+        """Publish a message to the device.
+
+        With raw=True the payload is already JSON-encoded text or bytes and is only wrapped in the envelope.
+        """
+        if raw:
+            if isinstance(payload, str):
+                payload = payload.encode()
+            message = b'{"type":' + orjson.dumps(message_type) + b',"payload":' + payload + b'}'
+        else:
+            message = orjson.dumps({
+                "type": message_type,
+                "payload": payload
+            })
+        return await self._publish_raw(message)
+
+    async def _publish_raw(self, message: bytes) -> bool:
+        """Publish an already encoded message to the device"""
+        topic = self._device_topic
+        if not topic or not self.mcp_client:
             return False
 
-        topic = f"$message/{self.device_id}"
-        message = json.dumps({
-            "type": message_type,
-            "payload": payload
-        })
-
-        return await self.mcp_client.publish_message(topic, message)
+        try:
+            return await self.mcp_client.publish_message(topic, message)
+        except Exception as e:
+            logger.error("publish to %s failed: %s", topic, e)
+            return False
 
     async def stream_chat(self, user_input: str) -> AsyncGenerator[AgentResponse, None]:
         """Streaming conversation - parallel processing of voice responses and tool calls"""
+        start_time = _now()
         try:
-            start_time = time.time()
-            logger.info(f"processing user input: '{user_input}'")
+            logger.info("processing user input: %r", user_input)
 
-            await self.message_to_device("message", {"type": "loading", "status": "processing"})
+            await self.message_to_device("message", _LOADING_PROCESSING, raw=True)
 
             # Parallel processing
             async for response in self._parallel_processing(user_input, start_time):
                 yield response
 
             # Complete processing
-            total_time = time.time() - start_time
-            logger.info(f"response completed: {total_time:.3f}s")
+            total_time = _now() - start_time
+            logger.info("response completed: %.3fs", total_time)
 
-            await self.message_to_device("message", {"type": "loading", "status": "complete"})
+            await self.message_to_device("message", _LOADING_COMPLETE, raw=True)
             yield AgentResponse(type=ResponseType.STREAM_END)
 
         except Exception as e:
-            error_time = time.time()
-            logger.error(f"error after {error_time - start_time:.3f}s: {e}")
+            logger.error("error after %.3fs: %s", _now() - start_time, e)
             yield AgentResponse(
                 type=ResponseType.ERROR,
                 content=str(e)
@@ -192,26 +252,52 @@ class ConversationWorkflow:
         """Simplified parallel processing"""
         logger.debug("starting parallel processing")
 
-        async with anyio.create_task_group() as tg:
-            # Start tool calling task (background)
-            async def tool_task():
+        # Start tool calling task (background)
+        async def tool_task():
+            with anyio.CancelScope() as scope:
+                self._tool_scopes.add(scope)
                 try:
-                    result = await self.emotion_agent.determine_and_call_tools(user_input, "")
+                    result = await self._determine_tools_once(user_input)
                     if result:
-                        logger.debug(f"tool result: {result}")
+                        logger.debug("tool result: %s", result)
                 except Exception as e:
-                    logger.error(f"tool error: {e}")
-
-            # Start tool calling task
-            tg.start_soon(tool_task)
-
-            # Stream voice response with proper tool execution
-            async for chunk in self.voice_agent.generate_response_stream(user_input):
-                yield AgentResponse(
-                    type=ResponseType.STREAM_CHUNK,
-                    content=chunk
-                )
-
+                    logger.error("tool error: %s", e)
+                finally:
+                    self._tool_scopes.discard(scope)
+
+        # Tool calls run on the workflow's long-lived task group. Before MCP is
+        # initialized the emotion agent has no tools, so there is nothing to run.
+        if self._bg_tg is not None:
+            self._bg_tg.start_soon(tool_task)
+
+        # Stream voice response with proper tool execution.
+        # The same response object is reused for every chunk, consumers
+        # must read it before advancing the stream.
+        chunk_response = AgentResponse(_STREAM_CHUNK)
+        async for chunk in self.voice_agent.generate_response_stream(user_input):
+            chunk_response.content = chunk
+            yield chunk_response
+
+
+    async def _determine_tools_once(self, user_input: str) -> Optional[Dict[str, Any]]:
+        """Run the emotion tool call, sharing the result with identical requests already in flight"""
+        # Same normalization as the emotion agent's tool call cache
+        key = self.emotion_agent.normalize_input(user_input)
+        inflight = self._inflight_tool_calls.get(key)
+        if inflight is not None:
+            event, holder = inflight
+            logger.debug("joining in-flight tool call for %r", user_input)
+            await event.wait()
+            return holder[0] if holder else None
+
+        event, holder = anyio.Event(), []
+        self._inflight_tool_calls[key] = (event, holder)
+        try:
+            holder.append(await self.emotion_agent.determine_and_call_tools(user_input, ""))
+        finally:
+            del self._inflight_tool_calls[key]
+            event.set()
+        return holder[0]
 
     def clear_history(self):
         """Clear conversation history"""
@@ -222,5 +308,7 @@ class ConversationWorkflow:
     async def shutdown(self):
         """Shutdown agent and connections"""
         logger.info("shutting down")
+        for scope in list(self._tool_scopes):
+            scope.cancel()
         if self.mcp_client:
             await self.mcp_client.stop()
@@ -5,6 +5,10 @@ import threading
 import queue
 
 import asyncio, anyio
+try:
+    import uvloop  # not available on Windows
+except ImportError:
+    uvloop = None
 from conversation_workflow import ConversationWorkflow, ResponseType
 
 # Message queue for sending to TTS
@@ -158,24 +162,24 @@ def asr_worker():
 
         async def _run_and_consume():
             async for response in workflow.stream_chat(user_input=tts_msg):
-                if response.type == ResponseType.STREAM_CHUNK:
+                if response.type is ResponseType.STREAM_CHUNK:
                     if response.content:  # Non-empty chunk
                         tts_queue.put({
                             'text': response.content,
                             'is_chunk': True,
                             'is_final': False
                         })
-                elif response.type == ResponseType.STREAM_END:
+                elif response.type is ResponseType.STREAM_END:
                     # Empty chunk signals end of stream
                     tts_queue.put({
                         'text': '',
                         'is_chunk': True,
                         'is_final': True
                     })
-                elif response.type == ResponseType.TOOL_CALL:
+                elif response.type is ResponseType.TOOL_CALL:
                     # Handle tool calls if needed
                     pass
-                elif response.type == ResponseType.ERROR:
+                elif response.type is ResponseType.ERROR:
                     print(f"Agent error: {response.content}", file=sys.stderr)
 
         # Submit async task to main thread event loop for execution
@@ -326,4 +330,7 @@ async def handle_batch(msgs):
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
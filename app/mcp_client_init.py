@@ -1,21 +1,21 @@
 from contextlib import AsyncExitStack
+from dataclasses import dataclass
 from datetime import timedelta
 
 import traceback
 import logging
 import re
-from typing import List, cast, Any
+from typing import List, Any
 import anyio
 from llama_index.core.tools import BaseTool, FunctionTool
 from mcp.client.mqtt import InitializeResult, MqttTransportClient
 from mcp.shared.mqtt import MqttOptions
-from pydantic import BaseModel
 from pydantic import Field, create_model
-import mcp.types as types
 
 logger = logging.getLogger(__name__)
 
-class McpServer(BaseModel):
+@dataclass(slots=True)
+class McpServer:
     server_name: str
     success: bool
 
@@ -32,6 +32,7 @@ class McpMqttClient:
         self.mcp_tools: list[BaseTool] = []
         self._stop_event = anyio.Event()
         self._connected_event = anyio.Event()
+        self._tools_ready = anyio.Event()
         self.on_tools_updated = on_tools_updated  # Tools update callback
 
     def is_connected(self) -> bool:
@@ -60,7 +61,7 @@ class McpMqttClient:
     async def stop(self):
         self._stop_event.set()
 
-    async def publish_message(self, topic: str, message: str) -> bool:
+    async def publish_message(self, topic: str, message: str | bytes) -> bool:
         """Publish a message to specified MQTT topic"""
         if not self._mqtt_client:
             logger.error("MQTT client not connected")
@@ -83,6 +84,13 @@ class McpMqttClient:
         else:
             return False
 
+    async def wait_tools_ready(self, timeout: float) -> bool:
+        """Wait until the first MCP tools are loaded, returns False on timeout"""
+        with anyio.move_on_after(timeout):
+            await self._tools_ready.wait()
+            return True
+        return False
+
     def get_mcp_servers(self):
         return self.mcp_servers
 
@@ -111,20 +119,23 @@ class McpMqttClient:
     async def on_mcp_connect(self, client, server_name, connect_result):
         success, _init_result = connect_result
         logger.info(f"Connect to MCP server name: {server_name}, result: {success}")
-        if success == "ok":
+        alive = success == "ok"
+        if alive:
             await self.load_mcp_tools(server_name)
         for server in self.mcp_servers:
             if server.server_name == server_name:
-                server.success = success == "ok"
+                server.success = alive
                 break
         else:
-            self.mcp_servers.append(McpServer(server_name=server_name, success=success))
+            self.mcp_servers.append(McpServer(server_name=server_name, success=alive))
 
     async def load_mcp_tools(self, server_name: str):
         logger.info(f"Loading MCP tools from server: {server_name}")
         try:
             ## note that we only support 1 MCP server now
             self.mcp_tools = await self._get_mcp_tools(server_name)
+            if self.mcp_tools:
+                self._tools_ready.set()
             logger.info(f"loaded tools: {[tool.metadata.name for tool in self.mcp_tools]}")
 
             # Notify tools updated callback
@@ -138,108 +149,94 @@ class McpMqttClient:
         client_session = self.get_session(server_name)
         all_tools = []
         try:
-            try:
-                tools_result = await client_session.list_tools()
-
-                if tools_result is False:
-                    return all_tools
-
-                list_tools_result = cast(types.ListToolsResult, tools_result)
-                tools = list_tools_result.tools
-
-                for tool in tools:
-                    logger.info(f"tool: {tool.name} - {tool.description}")
-
-                    def create_mcp_tool_wrapper(client_ref, tool_name):
-                        async def mcp_tool_wrapper(**kwargs):
-                            try:
-                                print(f"[MCP Tool Call] {tool_name} with args: {kwargs}")
-
-                                result = await client_ref.call_tool(
-                                    tool_name, kwargs
-                                )
-                                if result is False:
-                                    print(f"[MCP Tool Failed] {tool_name} returned False")
-                                    return f"call {tool_name} failed"
-
-                                call_result = cast(types.CallToolResult, result)
-
-                                if hasattr(call_result, "content") and call_result.content:
-                                    content_parts = []
-                                    for content_item in call_result.content:
-                                        if hasattr(content_item, "type"):
-                                            if content_item.type == "text":
-                                                text_content = cast(
-                                                    types.TextContent, content_item
-                                                )
-                                                content_parts.append(text_content.text)
-                                            elif content_item.type == "image":
-                                                image_content = cast(
-                                                    types.ImageContent, content_item
-                                                )
-                                                content_parts.append(
-                                                    f"[image: {image_content.mimeType}]"
-                                                )
-                                            elif content_item.type == "resource":
-                                                resource_content = cast(
-                                                    types.EmbeddedResource, content_item
-                                                )
-                                                content_parts.append(
-                                                    f"[resource: {resource_content.resource}]"
-                                                )
-                                            else:
-                                                content_parts.append(str(content_item))
-                                        else:
-                                            content_parts.append(str(content_item))
-
-                                    result_text = "\n".join(content_parts)
-
-                                    if (
-                                        hasattr(call_result, "isError")
-                                        and call_result.isError
-                                    ):
-                                        print(f"[MCP Tool Error] {tool_name}: {result_text}")
-                                        return f"tool return error: {result_text}"
-                                    else:
-                                        print(f"[MCP Tool Success] {tool_name}: {result_text}")
-                                        return result_text
-                                else:
-                                    print(f"[MCP Tool Success] {tool_name}: {str(call_result)}")
-                                    return str(call_result)
+            tools_result = await client_session.list_tools()
+        except Exception as e:
+            logger.error(f"Get tool list error: {e}")
+            return all_tools
 
-                            except Exception as e:
-                                logger.error(f"call tool error, tool_name: {tool_name}, stack: {traceback.format_exc()}")
-                                return f"call tool {tool_name} error: {str(e)}"
+        if tools_result is False:
+            return all_tools
 
-                        return mcp_tool_wrapper
+        tools = tools_result.tools
 
-                    wrapper_func = create_mcp_tool_wrapper(
-                        client_session, tool.name
-                    )
+        for tool in tools:
+            logger.info(f"tool: {tool.name} - {tool.description}")
 
+            def create_mcp_tool_wrapper(client_ref, tool_name):
+                async def mcp_tool_wrapper(**kwargs):
                     try:
-                        input_schema = getattr(tool, "inputSchema", {}) or {}
-                        fn_schema = build_fn_schema_from_input_schema(
-                            tool.name, input_schema
-                        )
-                        llamaindex_tool = FunctionTool.from_defaults(
-                            fn=wrapper_func,
-                            name=f"{tool.name}",
-                            description=tool.description or f"MCP tool: {tool.name}",
-                            async_fn=wrapper_func,
-                            fn_schema=fn_schema,
+                        print(f"[MCP Tool Call] {tool_name} with args: {kwargs}")
+
+                        result = await client_ref.call_tool(
+                            tool_name, kwargs
                         )
-                        all_tools.append(llamaindex_tool)
-                        # logger.info(f"call tool success: mcp_{tool.name}")
+                        if result is False:
+                            print(f"[MCP Tool Failed] {tool_name} returned False")
+                            return f"call {tool_name} failed"
+
+                        call_result = result
+
+                        if hasattr(call_result, "content") and call_result.content:
+                            content_parts = []
+                            for content_item in call_result.content:
+                                if hasattr(content_item, "type"):
+                                    if content_item.type == "text":
+                                        content_parts.append(content_item.text)
+                                    elif content_item.type == "image":
+                                        content_parts.append(
+                                            f"[image: {content_item.mimeType}]"
+                                        )
+                                    elif content_item.type == "resource":
+                                        content_parts.append(
+                                            f"[resource: {content_item.resource}]"
+                                        )
+                                    else:
+                                        content_parts.append(str(content_item))
+                                else:
+                                    content_parts.append(str(content_item))
+
+                            result_text = "\n".join(content_parts)
+
+                            if (
+                                hasattr(call_result, "isError")
+                                and call_result.isError
+                            ):
+                                print(f"[MCP Tool Error] {tool_name}: {result_text}")
+                                return f"tool return error: {result_text}"
+                            else:
+                                print(f"[MCP Tool Success] {tool_name}: {result_text}")
+                                return result_text
+                        else:
+                            print(f"[MCP Tool Success] {tool_name}: {str(call_result)}")
+                            return str(call_result)
 
                     except Exception as e:
-                        logger.error(f"create tool {tool.name} error: {e}")
+                        logger.error(f"call tool error, tool_name: {tool_name}, stack: {traceback.format_exc()}")
+                        return f"call tool {tool_name} error: {str(e)}"
 
-            except Exception as e:
-                logger.error(f"Get tool list error: {e}")
+                return mcp_tool_wrapper
 
-        except Exception as e:
-            logger.error(f"Get tool list error: {e}")
+            wrapper_func = create_mcp_tool_wrapper(
+                client_session, tool.name
+            )
+
+            try:
+                input_schema = getattr(tool, "inputSchema", {}) or {}
+                fn_schema = build_fn_schema_from_input_schema(
+                    tool.name, input_schema
+                )
+                llamaindex_tool = FunctionTool.from_defaults(
+                    fn=wrapper_func,
+                    name=f"{tool.name}",
+                    description=tool.description or f"MCP tool: {tool.name}",
+                    async_fn=wrapper_func,
+                    fn_schema=fn_schema,
+                )
+                all_tools.append(llamaindex_tool)
+                # logger.info(f"call tool success: mcp_{tool.name}")
+
+            except Exception as e:
+                logger.error(f"create tool {tool.name} error: {e}")
 
         return all_tools
 
@@ -1,6 +1,7 @@
 import asyncio
 import anyio
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from conversation_workflow import ConversationWorkflow, ResponseType
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -23,10 +24,14 @@ async def test_new_workflow():
         # Initialize MCP
         await workflow.init_mcp(tg, server_name_filter="#")
 
+        # One long-lived thread reads stdin so no thread is spawned per prompt
+        input_executor = ThreadPoolExecutor(max_workers=1)
+
         async def chat_loop():
+            loop = asyncio.get_running_loop()
             while True:
                 try:
-                    user_input = await asyncio.to_thread(input, "\nUser: ")
+                    user_input = await loop.run_in_executor(input_executor, input, "\nUser: ")
 
                     if user_input.lower() == 'exit':
                         break
@@ -38,16 +43,16 @@ async def test_new_workflow():
                     # Streaming conversation
                     print("Assistant: ", end="", flush=True)
                     async for response in workflow.stream_chat(user_input):
-                        if response.type == ResponseType.STREAM_CHUNK:
+                        if response.type is ResponseType.STREAM_CHUNK:
                             print(response.content, end="", flush=True)
-                        elif response.type == ResponseType.STREAM_END:
+                        elif response.type is ResponseType.STREAM_END:
                             print()  # Newline
-                        elif response.type == ResponseType.TOOL_CALL:
+                        elif response.type is ResponseType.TOOL_CALL:
                             # Print tool call details
                             print(f"\n[🔧 Tool Call] {response.tool_name}({response.tool_args})")
                             if response.tool_result:
                                 print(f"[✅ Result] {response.tool_result}")
-                        elif response.type == ResponseType.ERROR:
+                        elif response.type is ResponseType.ERROR:
                             print(f"\n❌ Error: {response.content}")
 
                 except KeyboardInterrupt:
@@ -57,6 +62,7 @@ async def test_new_workflow():
                     print(f"Error: {e}")
 
             # Close
+            input_executor.shutdown(wait=False)
             await workflow.shutdown()
 
         # Start chat loop
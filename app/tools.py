@@ -1,8 +1,19 @@
 import os
-from openai import OpenAI
+from openai import AsyncOpenAI
 from llama_index.core.tools import ToolOutput
 
 api_key = os.environ.get("DASHSCOPE_API_KEY")
+base_url = "https://dashscope.aliyuncs.com/compatible-mode/v1"
+
+_async_client: AsyncOpenAI | None = None
+
+
+def _get_async_client() -> AsyncOpenAI:
+    """Return the shared AsyncOpenAI client, created on first use inside the event loop"""
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncOpenAI(api_key=api_key, base_url=base_url)
+    return _async_client
 
 
 def process_tool_output(response_text):
@@ -12,10 +23,8 @@ def process_tool_output(response_text):
     return None
 
 
-def explain_photo(image_url: str, question: str) -> str:
-    """Explain the photo by the question. Used when users ask a question about the photo. The image_url is the url of the image."""
-
-    request_body = {
+def _build_photo_request(image_url: str, question: str) -> dict:
+    return {
         "role": "user",
         "content": [
             {
@@ -26,14 +35,8 @@ def explain_photo(image_url: str, question: str) -> str:
         ],
     }
 
-    client = OpenAI(
-        api_key=api_key,
-        base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-    )
-    completion = client.chat.completions.create(
-        model="qwen-vl-plus",
-        messages=[request_body],
-    )
+
+def _completion_content(completion) -> str:
     content = ""
     if completion.choices and hasattr(completion.choices[0], "message"):
         content = completion.choices[0].message.content
@@ -42,18 +45,22 @@ def explain_photo(image_url: str, question: str) -> str:
 
 async def explain_photo_async(image_url: str, question: str) -> str:
     """Explain the photo by the question asynchronously. Used when users ask a question about the photo. The image_url is the url of the image."""
-    return explain_photo(image_url, question)
+    client = _get_async_client()
+    completion = await client.chat.completions.create(
+        model="qwen-vl-plus",
+        messages=[_build_photo_request(image_url, question)],
+    )
+    return _completion_content(completion)
 
 
 def get_first_text_from_tool_output(tool_output: ToolOutput) -> str:
-    if tool_output is None or not hasattr(tool_output, "content"):
-        return ""
-    if hasattr(tool_output, "raw_output") and hasattr(
-        tool_output.raw_output, "content"
-    ):
+    try:
         content = tool_output.raw_output.content
-        if isinstance(content, list):
-            for item in content:
-                if hasattr(item, "type") and hasattr(item, "text"):
-                    return item.text
+    except AttributeError:
+        return ""
+    if isinstance(content, list):
+        return next(
+            (item.text for item in content if hasattr(item, "type") and hasattr(item, "text")),
+            "",
+        )
     return ""
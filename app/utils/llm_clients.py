@@ -0,0 +1,58 @@
+"""Shared OpenAI-compatible LLM clients"""
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from llama_index.llms.openai_like import OpenAILike
+
+# Maximum number of shared clients. Each distinct prompt_cache_key needs its own client,
+# the least recently used one is dropped and stays alive only while agents still hold it.
+LLM_CACHE_SIZE = 16
+
+# Client config -> shared client, so agents with the same config reuse one connection pool
+_LLM_CACHE: OrderedDict[tuple, OpenAILike] = OrderedDict()
+_LLM_CACHE_LOCK = threading.Lock()
+
+
+def get_shared_llm(
+    model: str,
+    api_key: str,
+    api_base: str,
+    temperature: float,
+    max_tokens: int,
+    timeout: float,
+    prompt_cache_key: Optional[str] = None,
+) -> OpenAILike:
+    """
+    Get an OpenAILike client shared by all callers with the same config
+
+    Args:
+        prompt_cache_key: Sent to the provider as extra_body.prompt_cache_key, part of the cache key
+            since it is stored on the client
+
+    Returns:
+        Shared chat and function calling client
+    """
+    key = (model, api_key, api_base, temperature, max_tokens, timeout, prompt_cache_key)
+    with _LLM_CACHE_LOCK:
+        llm = _LLM_CACHE.get(key)
+        if llm is not None:
+            _LLM_CACHE.move_to_end(key)
+        else:
+            llm = OpenAILike(
+                model=model,
+                api_key=api_key,
+                api_base=api_base,
+                is_chat_model=True,
+                is_function_calling_model=True,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                timeout=timeout,
+                additional_kwargs=(
+                    {"extra_body": {"prompt_cache_key": prompt_cache_key}} if prompt_cache_key else {}
+                ),
+            )
+            _LLM_CACHE[key] = llm
+            if len(_LLM_CACHE) > LLM_CACHE_SIZE:
+                _LLM_CACHE.popitem(last=False)
+    return llm
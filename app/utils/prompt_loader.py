@@ -1,14 +1,35 @@
 """Unified system prompt loading utility"""
+import functools
 import logging
+import os
+import threading
 from pathlib import Path
 
+import anyio
+
 logger = logging.getLogger(__name__)
 
+# Default prompt files of the voice and emotion agents, relative to the app directory
+VOICE_REPLY_PROMPT_FILE = "prompts/voice_reply_system_prompt.txt"
+EMOTION_PROMPT_FILE = "prompts/emotion_system_prompt.txt"
+
+# Resolved prompt path -> (mtime_ns, content)
+_PROMPT_CACHE: dict[Path, tuple[int, str]] = {}
+_PROMPT_CACHE_LOCK = threading.Lock()
+
+
+@functools.lru_cache(maxsize=8)
+def _resolve_prompt_path(prompt_file: str) -> Path:
+    return (Path(__file__).parent.parent / prompt_file).resolve()
+
 
 def load_system_prompt(prompt_file: str) -> str:
     """
     Load system prompt from file
 
+    The content is cached per file and reused until the file's mtime changes,
+    so repeated agent setups only pay for a stat call.
+
     Args:
         prompt_file: Relative path to prompt file (e.g., "prompts/voice_reply_system_prompt.txt")
 
@@ -19,17 +40,37 @@ def load_system_prompt(prompt_file: str) -> str:
         FileNotFoundError: If prompt file doesn't exist
         ValueError: If prompt file is empty
     """
-    prompt_path = Path(__file__).parent.parent / prompt_file
+    prompt_path = _resolve_prompt_path(prompt_file)
 
-    if not prompt_path.exists():
-        raise FileNotFoundError(f"System prompt file not found: {prompt_path}")
+    try:
+        mtime_ns = os.stat(prompt_path).st_mtime_ns
+    except FileNotFoundError:
+        raise FileNotFoundError(f"System prompt file not found: {prompt_path}") from None
+
+    cached = _PROMPT_CACHE.get(prompt_path)
+    if cached and cached[0] == mtime_ns:
+        return cached[1]
 
     try:
-        with open(prompt_path, "r", encoding="utf-8") as f:
-            content = f.read().strip()
-            if not content:
-                raise ValueError(f"System prompt file is empty: {prompt_path}")
-            return content
+        raw = prompt_path.read_bytes()
+        # Only pay for the stripped copy when the file actually has surrounding whitespace
+        if raw[:1].isspace() or raw[-1:].isspace():
+            content = raw.decode("utf-8").strip()
+        else:
+            content = raw.decode("utf-8")
+        if not content:
+            raise ValueError(f"System prompt file is empty: {prompt_path}")
     except Exception as e:
         logger.error(f"Error reading system prompt file {prompt_path}: {e}")
         raise
+
+    with _PROMPT_CACHE_LOCK:
+        _PROMPT_CACHE[prompt_path] = (mtime_ns, content)
+    return content
+
+
+async def preload_system_prompts(*prompt_files: str) -> None:
+    """Load prompt files into the cache from a worker thread, keeping file IO off the event loop"""
+    for prompt_file in prompt_files:
+        await anyio.to_thread.run_sync(load_system_prompt, prompt_file)
+
@@ -1,50 +1,76 @@
 import asyncio
-import json
-import random
+import itertools
+import time
 import traceback
+from collections import deque
 
 import anyio
+import orjson
 import websockets
-from typing import Dict, Optional
-from datetime import datetime
+try:
+    import uvloop  # not available on Windows
+except ImportError:
+    uvloop = None
+from typing import Dict, List, Optional
 from conversation_workflow import ConversationWorkflow, ResponseType
 from utils.colored_logger import get_agent_logger
+from utils.prompt_loader import EMOTION_PROMPT_FILE, VOICE_REPLY_PROMPT_FILE, preload_system_prompts
 
 logger = get_agent_logger("chat")
 mcp_server_name_prefix = "web-ui-hardware-controller/"
 
+# Streamed TTS text is batched before sending. The first batch of a stream is
+# flushed immediately, then the flush window grows geometrically up to the max.
+TTS_FLUSH_MIN_MS = 20
+TTS_FLUSH_MAX_MS = 160
+TTS_FLUSH_GROWTH_FACTOR = 2
+
 class DeviceManager:
-    def __init__(self, websocket):
+    def __init__(self, websocket, task_group: anyio.abc.TaskGroup):
         self.websocket = websocket
-        self.devices: Dict[str, asyncio.Queue] = {}  # device_id -> 消息队列
-        self.device_tasks: Dict[str, asyncio.Task] = {}  # device_id -> 协程任务
+        self.task_group = task_group  # hosts the MCP clients and tool calls of every device workflow
+        self.devices: Dict[str, deque] = {}  # device_id -> pending messages
+        self.device_tasks: Dict[str, asyncio.Task] = {}  # device_id -> in-flight drain task, absent when idle
         self.workflows: Dict[str, ConversationWorkflow] = {}  # device_id -> ConversationWorkflow实例
         self.current_task_ids: Dict[str, Optional[str]] = {}  # device_id -> 当前任务ID
+        self.tts_buffers: Dict[str, List[str]] = {}  # device_id -> pending TTS text
+        self.tts_flush_events: Dict[str, asyncio.Event] = {}  # device_id -> set when text is pending
+        self.tts_flush_tasks: Dict[str, asyncio.Task] = {}  # device_id -> TTS flusher of the current stream
+        self.tts_locks: Dict[str, asyncio.Lock] = {}  # device_id -> serializes TTS sends
+        self.next_request_id = itertools.count(1)  # JSON-RPC request ids, shared by all devices on this connection
+        self.tts_frame_templates: Dict[str, bytes] = {}  # device_id -> tts_and_send frame template of the current task
 
     async def start_device(self, device_id: str) -> None:
-        if device_id in self.device_tasks:
+        if device_id in self.devices:
             # stop the existing device first
             await self.stop_device(device_id)
-        
+
         # create a new message queue for the device
-        self.devices[device_id] = asyncio.Queue()
-        # start the device coroutine
-        task = asyncio.create_task(self.device_coroutine(device_id))
-        self.device_tasks[device_id] = task
+        self.devices[device_id] = deque()
+        self.tts_buffers[device_id] = []
+        self.tts_flush_events[device_id] = asyncio.Event()
+        self.tts_locks[device_id] = asyncio.Lock()
+        # the first drain connects the workflow, messages arriving meanwhile wait in the queue
+        self.schedule_drain(device_id)
 
     async def stop_device(self, device_id: str) -> None:
-        if device_id in self.device_tasks:
+        if device_id in self.devices:
             # 取消任务
-            task = self.device_tasks[device_id]
-            task.cancel()
-            try:
-                await task
-            except asyncio.CancelledError:
-                pass
+            task = self.device_tasks.pop(device_id, None)
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
 
-            del self.device_tasks[device_id]
-            if device_id in self.devices:
-                del self.devices[device_id]
+            del self.devices[device_id]
+
+            await self.stop_tts_flusher(device_id)
+            self.tts_buffers.pop(device_id, None)
+            self.tts_flush_events.pop(device_id, None)
+            self.tts_locks.pop(device_id, None)
+            self.tts_frame_templates.pop(device_id, None)
 
             if device_id in self.workflows:
                 workflow = self.workflows[device_id]
@@ -54,102 +80,186 @@ class DeviceManager:
             if device_id in self.current_task_ids:
                 del self.current_task_ids[device_id]
 
-            logger.info(f"Stopped device coroutine: {device_id}")
+            logger.info(f"Stopped device: {device_id}")
+
+    def schedule_drain(self, device_id: str) -> None:
+        """Start draining the device queue unless a drain is already in flight"""
+        if device_id not in self.device_tasks:
+            self.device_tasks[device_id] = asyncio.create_task(self.drain_device(device_id))
 
-    async def device_coroutine(self, device_id: str):
-        logger.info(f"Device coroutine {device_id} started")
+    async def init_workflow(self, device_id: str) -> ConversationWorkflow:
         workflow = ConversationWorkflow()
         suffix = device_id.split("-")[-1] if "-" in device_id else device_id
         server_name_filter = mcp_server_name_prefix + suffix
-        await workflow.init_mcp(server_name_filter=server_name_filter, device_id=device_id)
+        # Registered before connecting, so stop_device shuts it down even mid-init
         self.workflows[device_id] = workflow
+        try:
+            await workflow.init_mcp(self.task_group, server_name_filter=server_name_filter, device_id=device_id)
+        except Exception:
+            del self.workflows[device_id]
+            await workflow.shutdown()
+            raise
         logger.info(f"MCP initialized with server name filter: {server_name_filter}, device_id: {device_id}")
+        return workflow
+
+    async def drain_device(self, device_id: str):
+        """Process queued messages of one device in order, then exit until the next message"""
         try:
-            queue = self.devices[device_id]
-            while True:
-                message = await queue.get()
-                await self.process_device_message(device_id, message)
+            if device_id not in self.workflows:
+                await self.init_workflow(device_id)
+            pending = self.devices[device_id]
+            while pending:
+                try:
+                    await self.process_device_message(device_id, pending.popleft())
+                except Exception as e:
+                    logger.error(f"Device {device_id} error processing message: {e}")
 
         except asyncio.CancelledError:
-            logger.info(f"Device coroutine {device_id} cancelled")
+            logger.info(f"Device {device_id} drain cancelled")
             raise
         except Exception as e:
-            logger.error(f"Device coroutine {device_id} error: {e}")
+            logger.error(f"Device {device_id} error: {e}")
+        finally:
+            if self.device_tasks.get(device_id) is asyncio.current_task():
+                del self.device_tasks[device_id]
 
     async def process_device_message(self, device_id: str, message: dict) -> None:
         logger.info(f"Device {device_id} processing message: {message}")
         method = message.get('method')
         params = message.get('params', {})
-        device_id = params.get('device_id')
-        workflow = self.workflows.get(device_id)
         if method == 'asr_result':
-            input_text = params.get('text', None)
+            input_text = params.get('text')
         elif method == 'message_from_device':
-            input_text = params.get('payload', None)
+            input_text = params.get('payload')
         else:
             logger.warning(f"Unknown method {method} for device {device_id}")
             return
 
         if input_text:
-            async for response in workflow.stream_chat(user_input=input_text):
-                if response.type == ResponseType.STREAM_CHUNK:
-                    if response.content:  # Non-empty chunk
-                        await self.send_tts_request(device_id, response.content)
-                elif response.type == ResponseType.STREAM_END:
+            try:
+                workflow = self.workflows[device_id]
+            except KeyError:
+                logger.warning(f"No workflow for device {device_id}")
+                return
+
+            try:
+                async for response in workflow.stream_chat(user_input=input_text):
+                    if response.type is ResponseType.STREAM_CHUNK:
+                        if response.content:  # Non-empty chunk
+                            await self.send_tts_request(device_id, response.content)
+                    elif response.type is ResponseType.STREAM_END:
+                            await self.send_tts_finish(device_id)
+                    elif response.type is ResponseType.TOOL_CALL:
+                        # Handle tool calls if needed
+                        pass
+                    elif response.type is ResponseType.ERROR:
+                        logger.error(f"Error in workflow for device {device_id}: {response}")
+                        # No STREAM_END follows an error, finish here so the next reply starts a fresh stream
                         await self.send_tts_finish(device_id)
-                elif response.type == ResponseType.TOOL_CALL:
-                    # Handle tool calls if needed
-                    pass
-                elif response.type == ResponseType.ERROR:
-                    logger.error(f"Error in workflow for device {device_id}: {response}")
+            except Exception:
+                await self.send_tts_finish(device_id)
+                raise
 
     async def send_tts_request(self, device_id: str, text: str) -> None:
+        self.tts_buffers[device_id].append(text)
+        self.tts_flush_events[device_id].set()
+        if device_id not in self.tts_flush_tasks:
+            # one flusher per stream, stopped by send_tts_finish
+            self.tts_flush_tasks[device_id] = asyncio.create_task(self.tts_flusher(device_id))
+
+    async def stop_tts_flusher(self, device_id: str) -> None:
+        flush_task = self.tts_flush_tasks.pop(device_id, None)
+        if flush_task:
+            flush_task.cancel()
+            try:
+                await flush_task
+            except asyncio.CancelledError:
+                pass
+
+    async def tts_flusher(self, device_id: str) -> None:
+        """Send buffered TTS text in batches, waiting longer between batches as a stream goes on"""
+        event = self.tts_flush_events[device_id]
+        lock = self.tts_locks[device_id]
+        flush_ms = 0
+        while True:
+            await event.wait()
+            if flush_ms:
+                await asyncio.sleep(flush_ms / 1000)
+            event.clear()
+            try:
+                async with lock:
+                    await self.flush_tts_buffer(device_id)
+            except Exception as e:
+                logger.error(f"TTS flush for device {device_id} error: {e}")
+            flush_ms = min(max(flush_ms * TTS_FLUSH_GROWTH_FACTOR, TTS_FLUSH_MIN_MS), TTS_FLUSH_MAX_MS)
+
+    async def flush_tts_buffer(self, device_id: str) -> None:
+        """Send the buffered TTS text"""
+        buffer = self.tts_buffers.get(device_id)
+        if not buffer:
+            return
+        text = "".join(buffer)
+        buffer.clear()
+
         logger.info(f"Sent tts_request to device {device_id}: {text}")
         current_task_id = self.current_task_ids.get(device_id)
+        request_ids = self.next_request_id
         if current_task_id is None:
-            request_id = random.randint(1, 999999)
-            current_task_id = f"task-{int(datetime.now().timestamp())}-{request_id}"
+            current_task_id = f"task-{time.monotonic_ns()}"
             self.current_task_ids[device_id] = current_task_id
-            await send_json_rpc_request(self.websocket, "tts_and_send_start", request_id,
-                                  {"task_id": current_task_id, "device_id": device_id})
-            await send_json_rpc_request(self.websocket, "tts_and_send", request_id + 1,
-                                  {"task_id": current_task_id, "device_id": device_id, "text": text})
+            frame_template = tts_and_send_template(current_task_id, device_id)
+            self.tts_frame_templates[device_id] = frame_template
+            # Start and first text go out as two lines in one frame
+            await self.websocket.send(
+                encode_json_rpc_request("tts_and_send_start", next(request_ids),
+                                        {"task_id": current_task_id, "device_id": device_id})
+                + frame_template % (next(request_ids), orjson.dumps(text)),
+                text=True)
         else:
-            request_id = random.randint(1, 999999)
-            await send_json_rpc_request(self.websocket, "tts_and_send", request_id,
-                                  {"task_id": current_task_id, "device_id": device_id, "text": text})
+            frame_template = self.tts_frame_templates[device_id]
+            await self.websocket.send(frame_template % (next(request_ids), orjson.dumps(text)), text=True)
 
     async def send_tts_finish(self, device_id: str) -> None:
-        logger.info(f"Sent tts_finish to device {device_id}")
-        current_task_id = self.current_task_ids.get(device_id)
-        if current_task_id:
-            request_id = random.randint(1, 999999)
-            await send_json_rpc_request(self.websocket, "tts_and_send_finish", request_id,
-                                  {"task_id": current_task_id, "device_id": device_id})
-            self.current_task_ids[device_id] = None
+        async with self.tts_locks[device_id]:
+            # Holding the lock, the flusher isn't mid-send and can be stopped safely
+            await self.stop_tts_flusher(device_id)
+            self.tts_flush_events[device_id].clear()
+            try:
+                # Text still waiting in the buffer must go out before the finish
+                await self.flush_tts_buffer(device_id)
+                logger.info(f"Sent tts_finish to device {device_id}")
+                current_task_id = self.current_task_ids.get(device_id)
+                if current_task_id:
+                    await send_json_rpc_request(self.websocket, "tts_and_send_finish", next(self.next_request_id),
+                                          {"task_id": current_task_id, "device_id": device_id})
+            finally:
+                # A failed send must not leave the next reply appended to this task
+                self.current_task_ids[device_id] = None
+                self.tts_frame_templates.pop(device_id, None)
 
     async def route_message(self, message: dict) -> None:
         params = message.get('params', {})
         device_id = params.get('device_id')
         msg_q = self.devices.get(device_id)
-        if not msg_q:
+        if msg_q is None:
             logger.warning(f"No message queue for device {device_id}, we start it now.")
             await self.start_device(device_id)
             msg_q = self.devices.get(device_id)
-            if not msg_q:
+            if msg_q is None:
                 logger.error(f"Failed to create message queue for device {device_id}")
                 return
         # 将消息放入对应设备的队列
-        await msg_q.put(message)
+        msg_q.append(message)
+        self.schedule_drain(device_id)
 
     async def cleanup(self):
-        """Clean up all device coroutines"""
-        for device_id in list(self.device_tasks.keys()):
+        """Clean up all devices"""
+        for device_id in list(self.devices.keys()):
             await self.stop_device(device_id)
 
 class LineBufferedWebSocketHandler:
     def __init__(self):
-        self.buffer = ""
+        self.buffer = bytearray()
         self.websocket = None
 
     async def handle_client(self, websocket: websockets.ServerConnection):
@@ -157,36 +267,37 @@ class LineBufferedWebSocketHandler:
         logger.info(f"Client connected: {websocket.remote_address}")
     
         self.websocket = websocket
-        self.buffer = ""
-        device_manager = DeviceManager(websocket)
+        self.buffer = bytearray()
+        # One task group per connection hosts every device workflow's background tasks
+        async with anyio.create_task_group() as tg:
+            device_manager = DeviceManager(websocket, tg)
 
-        try:
-            async for message in websocket:
-                self.buffer += message
-                
-                while '\n' in self.buffer:
-                    line_end = self.buffer.index('\n')
-                    complete_line = self.buffer[:line_end]
-                    self.buffer = self.buffer[line_end + 1:]
-                    
-                    if complete_line:
-                        try:
-                            json_message = json.loads(complete_line)
-                        except json.JSONDecodeError:
-                            logger.error(f"Json decode failed: {complete_line}")
-                            continue
-
-                        await self.process_message(json_message, device_manager)
-
-        except websockets.exceptions.ConnectionClosed:
-            logger.info(f"Client disconnected: {websocket.remote_address}")
-        except Exception as e:
-            logger.error(f"Error when handling client: {e}, stacktrace: {traceback.format_exc()}")
-        finally:
-            # Clean up all device coroutines
-            await device_manager.cleanup()
-            if self.buffer.strip():
-                logger.warning(f"Buffer still has unprocessed data: {self.buffer}")
+            try:
+                async for message in websocket:
+                    self.buffer.extend(message if isinstance(message, bytes) else message.encode())
+
+                    while (line_end := self.buffer.find(b'\n')) != -1:
+                        complete_line = self.buffer[:line_end]  # one copy, orjson parses bytearray directly
+                        del self.buffer[:line_end + 1]
+
+                        if complete_line:
+                            try:
+                                json_message = orjson.loads(complete_line)
+                            except orjson.JSONDecodeError:
+                                logger.error(f"Json decode failed: {complete_line}")
+                                continue
+
+                            await self.process_message(json_message, device_manager)
+
+            except websockets.exceptions.ConnectionClosed:
+                logger.info(f"Client disconnected: {websocket.remote_address}")
+            except Exception as e:
+                logger.error(f"Error when handling client: {e}, stacktrace: {traceback.format_exc()}")
+            finally:
+                # Clean up all devices, their MCP clients stop and the task group can exit
+                await device_manager.cleanup()
+                if self.buffer.strip():
+                    logger.warning(f"Buffer still has unprocessed data: {self.buffer}")
 
     async def process_message(self, message: dict, device_manager: DeviceManager) -> None:
         method = message.get('method')
@@ -225,7 +336,7 @@ async def send_json_rpc_error(websocket: websockets.ServerConnection, id, code,
         },
         "id": id
     }
-    await websocket.send(json.dumps(error_response) + '\n')
+    await websocket.send(orjson.dumps(error_response) + b'\n', text=True)
 
 async def send_json_rpc_result(websocket: websockets.ServerConnection, method, id, result):
     result_response = {
@@ -234,16 +345,24 @@ async def send_json_rpc_result(websocket: websockets.ServerConnection, method, i
         "id": id,
         "result": result
     }
-    await websocket.send(json.dumps(result_response) + '\n')
+    await websocket.send(orjson.dumps(result_response) + b'\n', text=True)
 
-async def send_json_rpc_request(websocket: websockets.ServerConnection, method, id, params):
+def encode_json_rpc_request(method, id, params) -> bytes:
     request = {
         "jsonrpc": "2.0",
         "method": method,
         "id": id,
         "params": params
     }
-    await websocket.send(json.dumps(request) + '\n')
+    return orjson.dumps(request) + b'\n'
+
+def tts_and_send_template(task_id: str, device_id: str) -> bytes:
+    """Pre-encode a tts_and_send request for one task, leaving %d for the id and %b for the JSON text"""
+    params_prefix = orjson.dumps({"task_id": task_id, "device_id": device_id})[:-1].replace(b'%', b'%%')
+    return b'{"jsonrpc":"2.0","method":"tts_and_send","id":%d,"params":' + params_prefix + b',"text":%b}}\n'
+
+async def send_json_rpc_request(websocket: websockets.ServerConnection, method, id, params):
+    await websocket.send(encode_json_rpc_request(method, id, params), text=True)
 
 async def send_json_rpc_notification(websocket, method, params):
     notification = {
@@ -251,14 +370,18 @@ async def send_json_rpc_notification(websocket, method, params):
         "method": method,
         "params": params
     }
-    await websocket.send(json.dumps(notification) + '\n')
+    await websocket.send(orjson.dumps(notification) + b'\n', text=True)
 
 async def start_websocket_server(host='localhost', port=8765):
     """Start WebSocket server"""
+    await preload_system_prompts(VOICE_REPLY_PROMPT_FILE, EMOTION_PROMPT_FILE)
     handler = LineBufferedWebSocketHandler()
     logger.info(f"WebSocket server started at ws://{host}:{port}")
     async with websockets.serve(handler.handle_client, host, port):
         await asyncio.Future()
 
 if __name__ == "__main__":
-    asyncio.run(start_websocket_server())
+    if uvloop:
+        uvloop.run(start_websocket_server())
+    else:
+        asyncio.run(start_websocket_server())